@@ -4,11 +4,51 @@
 # Alan Barr (GitHub: freedom35)
 # July 2023
 #################################################
+import itertools
+import pathlib
 import sqlite3
 import sys
 import os
 
 
+# Table alignment for data types, center aligned if numeric
+# (Matched by exact type, bool is a subclass of int but not numeric)
+TYPE_ALIGNMENTS = {int: ':-:', float: ':-:'}
+
+# Database settings for bulk reads
+# (256 MiB memory-mapped I/O, 64 MiB page cache, in-memory temp storage)
+READ_PRAGMAS = (
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Number of rows fetched from database per batch
+FETCH_BATCH_ROWS = 1000
+
+# Max number of leading rows checked for field alignment
+ALIGNMENT_MAX_ROWS = FETCH_BATCH_ROWS
+
+# Number of rows formatted per chunk
+FORMAT_CHUNK_ROWS = 10000
+
+# Number of markdown lines joined per write to output file
+EXPORT_BATCH_LINES = 1000
+
+# Output data buffered before each write (1 MiB)
+EXPORT_BUFFER_SIZE = 1 << 20
+
+# Max number of buffers per scatter-gather write
+# (Default used if system limit unavailable or indeterminate)
+try:
+    WRITEV_MAX_BUFFERS = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    WRITEV_MAX_BUFFERS = -1
+
+if WRITEV_MAX_BUFFERS <= 0:
+    WRITEV_MAX_BUFFERS = 1024
+
+
 #######################################
 # Main method
 #######################################
@@ -32,18 +72,16 @@ def main():
             print('SQL file not found: {}'.format(sql_file))
             return
 
-        # Separate directory/filename
-        tmp = os.path.split(sql_file)
-        sql_file_dir = tmp[0]
-        sql_file_with_ext = tmp[1]
-
-        # Separate filename/ext
-        tmp = os.path.splitext(sql_file_with_ext)
-        sql_file_without_ext = tmp[0]
-        sql_file_ext = tmp[1]
+        # Separate directory/filename/ext
+        sql_path = pathlib.Path(sql_file)
+        sql_file_dir = sql_path.parent
+        sql_file_with_ext = sql_path.name
+        sql_file_without_ext = sql_path.stem
+        sql_file_ext = sql_path.suffix
 
         # Export to same directory as SQL file if optional dir not specified
-        export_dir = sys.argv[3] if len(sys.argv) > 3 else sql_file_dir
+        export_dir = (pathlib.Path(sys.argv[3]) if len(sys.argv) > 3
+                      else sql_file_dir)
 
         # File ext for output file
         MARKDOWN_EXT = '.md'
@@ -59,7 +97,7 @@ def main():
         sql = read_query(sql_file)
 
         # Query DB
-        conn = sqlite3.connect(db_file)
+        conn = open_database(db_file)
 
         results = get_results(conn, sql)
 
@@ -70,16 +108,17 @@ def main():
         title = format_title(sql_file_without_ext)
 
         # Format results as markdown
+        # (Lines are generated as rows are read from the cursor)
         markdown = create_markdown(title, comments, results)
 
-        # Check to create dir for output file
-        if not os.path.exists(export_dir):
-            os.makedirs(export_dir)
+        # Create dir for output file if it does not exist
+        export_dir.mkdir(parents=True, exist_ok=True)
 
         # Get output path
         export_file = sql_file_without_ext + MARKDOWN_EXT
-        export_path = os.path.join(export_dir, export_file)
+        export_path = export_dir / export_file
 
+        # Stream markdown lines to file
         export_to_file(export_path, markdown)
 
         # Tidy up
@@ -116,6 +155,22 @@ def read_query(path):
     return sql
 
 
+#######################################
+# Open database for reading
+#######################################
+def open_database(path):
+    # Open as read-only (URI mode), no journal required
+    # (Autocommit, statements run as written including any transactions)
+    uri = pathlib.Path(path).resolve().as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, isolation_level=None)
+
+    # Tune for reading large results
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+
+    return conn
+
+
 #######################################
 # Get any header comments from sql
 #######################################
@@ -123,12 +178,19 @@ def get_header_comments(sql):
     comments = []
 
     # Check start of file for comments
-    for line in sql.splitlines():
-        if line.startswith('--'):
-            # Remove comment marker and any spaces
-            comments.append(line.lstrip('- ').rstrip(' \r\n'))
-        else:
-            break
+    # (Scan line by line, stop at first non-comment line)
+    start = 0
+
+    while sql.startswith('--', start):
+        end = sql.find('\n', start)
+
+        if end == -1:
+            end = len(sql)
+
+        # Remove comment marker and any spaces
+        comments.append(sql[start:end].lstrip('- ').rstrip(' \r'))
+
+        start = end + 1
 
     return comments
 
@@ -137,112 +199,312 @@ def get_header_comments(sql):
 # Get results from database
 #######################################
 def get_results(conn, sql):
+    statements = split_statements(sql)
+
+    if len(statements) == 0:
+        raise ValueError('No SQL statements found')
+
+    # Run any statements before query in full
+    # (Closing cursor ends statement, any rows are not used)
+    for statement in statements[:-1]:
+        conn.execute(statement).close()
+
     # Get database cursor
     cur = conn.cursor()
 
-    # Execute SQL statement
-    cur.execute(sql)
-  
-    # Get list of column names for query
-    names = list(map(lambda x: x[0], cur.description))
+    # Set number of rows returned by each fetchmany call
+    cur.arraysize = FETCH_BATCH_ROWS
+
+    # Execute last SQL statement as query
+    # (Rows are fetched later, so no statements can follow it)
+    cur.execute(statements[-1])
 
-    # Get results into a table (list of lists)
-    selected_results = cur.fetchall()
+    if cur.description is None:
+        raise ValueError('Last SQL statement must return rows')
+
+    # Get list of column names for query
+    names = [column[0] for column in cur.description]
 
     # Return tuple
-    return (names, selected_results)
+    # (Rows are fetched lazily so full result set is never held in memory)
+    return (names, fetch_rows(cur))
+
+
+#######################################
+# Split SQL into separate statements
+#######################################
+def split_statements(sql):
+    statements = []
+    start = 0
+
+    # Check each semicolon for end of a complete statement
+    # (Ignores semicolons within strings, comments, or triggers)
+    end = sql.find(';')
+
+    while end != -1:
+        statement = sql[start:end + 1]
+
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            start = end + 1
+
+        end = sql.find(';', end + 1)
+
+    # Add any remaining SQL without a trailing semicolon
+    statements.append(sql[start:])
+
+    # Ignore statements containing only comments/whitespace
+    return [s for s in statements if not is_empty_statement(s)]
+
+
+#######################################
+# Check statement has no SQL to run
+#######################################
+def is_empty_statement(statement):
+    sql = statement.lstrip()
+
+    # Skip any comments or empty statements
+    while len(sql) > 0:
+        if sql.startswith(';'):
+            sql = sql[1:]
+        elif sql.startswith('--'):
+            end = sql.find('\n')
+            sql = '' if end == -1 else sql[end + 1:]
+        elif sql.startswith('/*'):
+            end = sql.find('*/')
+            sql = '' if end == -1 else sql[end + 2:]
+        else:
+            return False
+
+        sql = sql.lstrip()
+
+    return True
+
+
+#######################################
+# Fetch rows from cursor in batches
+#######################################
+def fetch_rows(cur):
+    while True:
+        batch = cur.fetchmany()
+
+        # Check for end of results
+        if len(batch) == 0:
+            break
+
+        yield from batch
 
 
 #######################################
 # Create markdown content
 #######################################
 def create_markdown(title, body, table):
-    lines = []
-    
     # Title
-    lines.append('# {}'.format(title))
-    lines.append('')
+    yield '# {}'.format(title)
+    yield ''
 
     # Optional body
     if len(body) > 0:
         for s in body:
-            lines.append(s)
+            yield s
 
         # Add extra line if added body
-        lines.append('')
+        yield ''
 
     # Table
     if len(table) < 2:
-        return lines
+        return
 
     fields = table[0]
-    rows = table[1]
+    row_iter = iter(table[1])
 
-    # Check for row data
-    if len(rows) == 0:
-        return lines
+    # Peek first row to check for row data
+    first_row = next(row_iter, None)
 
-    # Build table markdown:
-    # Start with table headings
-    headings = '|'
+    if first_row is None:
+        return
 
-    for field in fields:
-        # Add field name, replace underscores
-        headings += field.replace('_', ' ').strip() + '|'
+    # Alignment for each field, left if data type unknown
+    alignments = ['---'] * len(fields)
 
-    lines.append(headings)
+    # Cell formatter for each field, text unless numeric value found
+    formatters = [format_text_cell] * len(fields)
 
-    # Create table alignment
-    alignment = '|'
+    # Buffer leading rows until every field has a non-null value
+    # (or rows run out), so alignment can be determined before
+    # any row data is written - limited so a field that is always
+    # null does not buffer the entire result set
+    rows = [first_row]
+    row = first_row
+    unknown = range(len(fields))
 
-    # Loop fields by index
-    for i in range(len(fields)):
-        field_alignment = None
+    while True:
+        # Only check fields without a non-null value so far
+        still_unknown = []
 
-        # Iterate each row until a non-null value is found
-        for row in rows:
+        for i in unknown:
             # Get value for current field
             val = row[i]
 
             if val is None:
+                still_unknown.append(i)
                 continue
-            
+
             # Align fields based on data type
             # Center align if numeric, left align if not
-            if isinstance(val, int) or isinstance(val, float):
-                field_alignment = ':-:|'
-            else:
-                field_alignment = '---|'
+            alignment = TYPE_ALIGNMENTS.get(type(val))
 
+            if alignment is not None:
+                alignments[i] = alignment
+                formatters[i] = format_cell
+
+        unknown = still_unknown
+
+        # Fields still unknown at limit are left aligned
+        if len(unknown) == 0 or len(rows) >= ALIGNMENT_MAX_ROWS:
             break
-        
-        # Default alignment left if data type unknown
-        alignment += (field_alignment if field_alignment is not None 
-                      else '---|')
 
-    # Add table alignment row
-    lines.append(alignment)
+        row = next(row_iter, None)
+
+        if row is None:
+            break
+
+        rows.append(row)
+
+    # Build table markdown:
+    # Start with table headings (replace underscores), then alignment
+    headings = [field.replace('_', ' ').strip() for field in fields]
+
+    yield format_table_line(headings)
+    yield format_table_line(alignments)
 
     # Row data
-    for row in rows:
-        lines.append('|{}|'.format('|'.join(
-            [str(i) if i is not None else '' for i in row])))
+    # (Buffered rows first, then remaining rows from cursor)
+    yield from format_rows(formatters, itertools.chain(rows, row_iter))
+
+
+#######################################
+# Format table line from list of cells
+#######################################
+def format_table_line(cells):
+    return '|' + '|'.join(cells) + '|'
+
 
-    return lines
+#######################################
+# Format table rows as markdown
+#######################################
+def format_rows(formatters, rows):
+    # Split rows into chunks for formatting
+    chunks = iter(
+        lambda: list(itertools.islice(rows, FORMAT_CHUNK_ROWS)), [])
+
+    for chunk in chunks:
+        yield from format_chunk(formatters, chunk)
+
+
+#######################################
+# Format chunk of table rows as markdown
+#######################################
+def format_chunk(formatters, rows):
+    # Transpose rows to columns and format each column in one map call
+    # (Formatter for column is applied without per-cell lookup)
+    columns = [list(map(fmt, column))
+               for fmt, column in zip(formatters, zip(*rows))]
+
+    # Transpose formatted columns back to rows
+    return ['|' + '|'.join(cells) + '|' for cells in zip(*columns)]
 
 
 #######################################
 # Export to file
 #######################################
 def export_to_file(path, markdown):
-    # Create file for writing
-    with open(path, 'w') as f:
-        # Insert newline char between each item
-        # (Otherwise list will be concatenated into one line)
-        separate_lines = map(lambda x: f"{x}\n", markdown)
+    lines = iter(markdown)
+
+    # Write to temporary file in same dir, replaces file once complete
+    # (Existing file kept if an error occurs while reading rows)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    # Create file for writing (must not already exist)
+    # (Binary mode on Windows, content encoded as UTF-8,
+    # permissions restricted by umask as with open())
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    fd = os.open(temp_path, flags, 0o666)
+
+    try:
+        write_lines(fd, lines)
+    except BaseException:
+        os.close(fd)
+        os.unlink(temp_path)
+        raise
+
+    os.close(fd)
+
+    try:
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+#######################################
+# Write lines to file in batches
+#######################################
+def write_lines(fd, lines):
+    # Encoded batches waiting to be written
+    buffers = []
+    size = 0
+
+    while True:
+        # Take next batch of lines
+        # (Markdown is streamed so only join a batch at a time)
+        batch = list(itertools.islice(lines, EXPORT_BATCH_LINES))
+
+        if len(batch) == 0:
+            break
+
+        # Insert newline char between each item and encode batch
+        data = ('\n'.join(batch) + '\n').encode('utf-8')
+
+        buffers.append(data)
+        size += len(data)
+
+        # Write batches together once enough data is buffered
+        # (Avoids copying batches into a single buffer)
+        if size >= EXPORT_BUFFER_SIZE:
+            write_buffers(fd, buffers)
+            buffers = []
+            size = 0
+
+    # Write any remaining batches
+    write_buffers(fd, buffers)
+
+
+#######################################
+# Write list of buffers to file
+#######################################
+def write_buffers(fd, buffers):
+    # Scatter-gather write not available on all platforms (e.g. Windows)
+    if not hasattr(os, 'writev'):
+        buffers = [b''.join(buffers)]
 
-        # Write all lines to file
-        f.writelines(separate_lines)
+    index = 0
+
+    while index < len(buffers):
+        if hasattr(os, 'writev'):
+            # Write multiple buffers per system call
+            written = os.writev(fd, buffers[index:index + WRITEV_MAX_BUFFERS])
+        else:
+            written = os.write(fd, buffers[index])
+
+        # Skip buffers that were written in full
+        while index < len(buffers) and written >= len(buffers[index]):
+            written -= len(buffers[index])
+            index += 1
+
+        # Keep remainder of partially written buffer
+        if written > 0:
+            buffers[index] = buffers[index][written:]
 
 
 #######################################
@@ -255,6 +517,23 @@ def format_title(title):
     return title
 
 
+#######################################
+# Format table cell value for markdown
+#######################################
+def format_cell(val):
+    # Empty cell for null values
+    return '' if val is None else str(val)
+
+
+#######################################
+# Format text table cell value for markdown
+#######################################
+def format_text_cell(val):
+    # Text values used as-is, otherwise format as any other cell
+    # (SQLite columns are not strictly typed, may contain other types)
+    return val if type(val) is str else format_cell(val)
+
+
 #######################################
 # Local entrypoint
 #######################################